@@ -1,7 +1,10 @@
 import logging
+import threading
 
-import cvxpy as cp
 import numpy as np
+import osqp
+import scipy.sparse as sp
+from numba import njit, prange
 
 
 def gaussian_decay(distances, bandwidth, capture_range):
@@ -9,7 +12,8 @@ def gaussian_decay(distances, bandwidth, capture_range):
     Calculate Gaussian decay based on distance, bandwidth, and capture range.
     
     Args:
-    - distances (np.ndarray): Distance matrix between demand points and candidate supply sites.
+    - distances (np.ndarray or scipy.sparse matrix): Distance matrix between demand points and candidate supply sites.
+      For a sparse matrix only the stored distances are decayed, and the result keeps the same sparsity.
     - bandwidth (float): The bandwidth for the Gaussian decay function, controlling the spread of influence.
     - capture_range (float): Maximum range for coverage. Beyond this distance, the value is set to 0.
 
@@ -18,13 +22,142 @@ def gaussian_decay(distances, bandwidth, capture_range):
     while rural areas are modeled with a bandwidth of 3km and a capture range of 5km.
     
     Returns:
-    - np.ndarray: Decay values based on Gaussian function.
+    - np.ndarray or scipy.sparse matrix: Decay values based on Gaussian function.
     """
-    decay_values = np.exp(-(distances ** 2) / (2 * bandwidth ** 2))
-    decay_values[distances >= capture_range] = 0
+    # The kernel writes its output in the input dtype, so integer distances are decayed in float64;
+    # float32 distances keep their single precision
+    dtype = distances.dtype if np.issubdtype(distances.dtype, np.floating) else np.float64
+
+    if sp.issparse(distances):
+        decay_values = distances.astype(dtype, copy=True)
+        decay_values.data = _gaussian_decay_kernel(decay_values.data, float(bandwidth), float(capture_range))
+        decay_values.eliminate_zeros()
+        return decay_values
+
+    distances = np.ascontiguousarray(distances, dtype=dtype)
+    return _gaussian_decay_kernel(distances.ravel(), float(bandwidth), float(capture_range)).reshape(distances.shape)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _gaussian_decay_kernel(distances, bandwidth, capture_range):
+    """
+    Fused square/scale/exp/threshold pass over a flat array of distances, without intermediate arrays.
+    """
+    decay_values = np.empty_like(distances)
+    scale = -1.0 / (2.0 * bandwidth ** 2)
+    for i in prange(distances.shape[0]):
+        d = distances[i]
+        decay_values[i] = np.exp(d * d * scale) if d < capture_range else 0.0
     return decay_values
 
 
+@njit(parallel=True, cache=True)
+def _covered_demand(distance_matrix, selected_sites, demand_values, capture_range):
+    """
+    Sum the demand of the rows that have at least one selected site within the capture range.
+    """
+    covered_demand = 0.0
+    for i in prange(distance_matrix.shape[0]):
+        for j in selected_sites:
+            if distance_matrix[i, j] <= capture_range:
+                covered_demand += demand_values[i]
+                break
+    return covered_demand
+
+
+@njit(parallel=True, cache=True)
+def _covered_demand_sparse(indptr, indices, distances, is_selected, demand_values, capture_range):
+    """
+    Same as _covered_demand for a distance matrix in CSR form, where only the stored distances are considered.
+    """
+    covered_demand = 0.0
+    for i in prange(indptr.shape[0] - 1):
+        for p in range(indptr[i], indptr[i + 1]):
+            if is_selected[indices[p]] and distances[p] <= capture_range:
+                covered_demand += demand_values[i]
+                break
+    return covered_demand
+
+
+@njit(fastmath=True, cache=True)
+def _metrics_kernel(Ai, demand, total_demand, A_bar):
+    """
+    Compute A_hat, min_Ai, max_Ai, MD, MAD, CV and Gini in a single pass over the demand points sorted by Ai.
+
+    The Gini terms P[i-1] * T[i] - T[i-1] * P[i] are accumulated on the unnormalized cumulative sums
+    and scaled once at the end.
+    """
+    order = np.argsort(Ai, kind='mergesort')
+    squared_sum = 0.0
+    abs_sum = 0.0
+    MD = 0.0
+    cumulative_D = 0.0
+    cumulative_Ai_Di = 0.0
+    gini_sum = 0.0
+    for i in order:
+        diff = Ai[i] - A_bar
+        squared_sum += diff * diff * demand[i]
+        abs_sum += abs(diff) * demand[i]
+        MD = max(MD, abs(diff))
+
+        next_D = cumulative_D + demand[i]
+        next_Ai_Di = cumulative_Ai_Di + Ai[i] * demand[i]
+        gini_sum += cumulative_D * next_Ai_Di - cumulative_Ai_Di * next_D
+        cumulative_D = next_D
+        cumulative_Ai_Di = next_Ai_Di
+
+    A_hat = np.sqrt(squared_sum / total_demand)
+    MAD = abs_sum / total_demand
+    CV = A_hat / A_bar
+    Gini = 1 + gini_sum / (total_demand * cumulative_Ai_Di)
+    return A_hat, Ai[order[0]], Ai[order[-1]], MD, MAD, CV, Gini
+
+
+# OSQP settings matching the defaults CVXPY applies when it calls OSQP
+_OSQP_SETTINGS = {
+    'eps_abs': 1e-5,
+    'eps_rel': 1e-5,
+    'max_iter': 10000,
+    'polish' if osqp.__version__.startswith('0.') else 'polishing': True,
+}
+_OSQP_SOLVED = (1, 2)  # OSQP_SOLVED, OSQP_SOLVED_INACCURATE
+
+
+def _make_capacity_qp(k, x_min, x_max, total_supply, A_bar_value):
+    """
+    Set up a persistent OSQP workspace for the supply-distribution QP over k selected sites:
+
+        minimize    0.5 * x.T @ P_T_D_P @ x - (P.T @ D @ A_bar) @ x
+        subject to  x_min <= x <= x_max,  sum(x) == total_supply
+
+    Only P_T_D_P depends on the candidate site. It is set up with a dense upper-triangular pattern and
+    replaced through solver.update(Px=...) for every candidate.
+
+    Returns:
+    - tuple: (solver, (rows, cols)) where rows and cols index the upper-triangular entries in OSQP's storage order.
+    """
+    P_pattern = sp.triu(np.ones((k, k)), format='csc')
+    rows = P_pattern.indices
+    cols = np.repeat(np.arange(k), np.diff(P_pattern.indptr))
+
+    # P.T @ D @ A_bar reduces to A_bar for every site since G normalizes each column
+    q = np.full(k, -A_bar_value)
+
+    # Define the constraints
+    # In this project, for the Atlanta metropolitan area, the constraints are set to (2, 25),
+    # meaning the minimum supply per site is 2, and the maximum is 25.
+    # For other areas, the constraints are set to (1, None), meaning the minimum supply is 1
+    # with no upper limit.
+    # The last row ensures the total supply matches the predefined total.
+    A = sp.vstack([sp.eye(k), np.ones((1, k))], format='csc')
+    lower = np.append(np.full(k, -np.inf if x_min is None else x_min), total_supply)
+    upper = np.append(np.full(k, np.inf if x_max is None else x_max), total_supply)
+
+    solver = osqp.OSQP()
+    solver.setup(P_pattern, q, A, lower, upper, verbose=False, **_OSQP_SETTINGS)
+    return solver, (rows, cols)
+
+
 class CapacityOptimizer:
     """
     This class implements the Quadratic Programming (QP) model to optimize supply distribution for Electric Vehicle Charging Stations (EVCS)
@@ -41,18 +174,98 @@ class CapacityOptimizer:
         Args:
         - total_supply (float): Total supply(= EV Ports) to be distributed among selected sites.
         - demand (np.ndarray): Demand values for each demand point.
-        - distance_matrix (np.ndarray): Distance matrix between demand points and candidate supply sites.
+        - distance_matrix (np.ndarray or scipy.sparse matrix): Distance matrix between demand points and candidate supply sites.
         - bandwidth (float): Bandwidth for the Gaussian decay function.
         - capture_range (float): Maximum range for coverage.
         """
+        demand = np.asarray(demand, dtype=np.float32)
         self.total_supply = total_supply
-        self.total_demand = np.sum(demand)
+        self.total_demand = np.sum(demand, dtype=np.float64)
         self.A_bar_value = self.total_supply / self.total_demand  # Average supply per unit of demand
-        self.F = gaussian_decay(distance_matrix, bandwidth, capture_range)
-        self.D = np.diag(demand)
+        # Most demand points lie beyond the capture range of most sites, so F is kept sparse.
+        # CSC storage makes the column slicing F[:, sites] used throughout the optimization cheap.
+        # The n x m decay terms are stored in single precision; the sums over demand points below are
+        # accumulated in double precision.
+        self.F = sp.csc_matrix(gaussian_decay(distance_matrix, bandwidth, capture_range), dtype=np.float32)
         self.capture_range = capture_range
+        self._solvers = {}  # Idle OSQP workspaces per (k, constraints); a workspace serves one thread at a time
+        self._lock = threading.Lock()
+
+        # Demand-weighted decay D @ F and its column terms, shared by every candidate evaluation
+        self.DF = sp.csc_matrix(self.F.multiply(demand[:, np.newaxis]))
+        self._column_demand = np.asarray(self.DF.sum(axis=0, dtype=np.float64)).ravel()  # F[:, j] @ D @ 1
+        self._gram_diag = np.asarray(self.F.multiply(self.DF).sum(axis=0, dtype=np.float64)).ravel()  # F[:, j] @ D @ F[:, j]
+        self._step_key = None
+        self._step_gram = None
+
+    def prepare_solver(self, k, constraints):
+        """
+        Set up the OSQP workspace for k selected sites ahead of the greedy step that uses it.
+
+        Only one problem size is in use per greedy step, so workspaces are set up per step and
+        released with free_solvers afterwards rather than kept for every size at once.
+        """
+        key = (k, tuple(constraints))
+        with self._lock:
+            if self._solvers.get(key):
+                return
+        x_min, x_max = constraints
+        solver = _make_capacity_qp(k, x_min, x_max, self.total_supply, self.A_bar_value)
+        with self._lock:
+            self._solvers.setdefault(key, []).append(solver)
+
+    def free_solvers(self, k, constraints):
+        """
+        Release the OSQP workspaces for k selected sites once their greedy step is finished.
+        """
+        with self._lock:
+            self._solvers.pop((k, tuple(constraints)), None)
+
+    def _acquire_solver(self, k, constraints):
+        """
+        Take an idle OSQP workspace for k selected sites, setting up a new one if all of them are in use.
+
+        Candidate evaluations of one greedy step share the same problem size and bounds, so a workspace
+        is reused across candidates and afterwards only P_T_D_P is updated.
+        """
+        key = (k, tuple(constraints))
+        with self._lock:
+            idle = self._solvers.setdefault(key, [])
+            if idle:
+                return key, idle.pop()
+        x_min, x_max = constraints
+        return key, _make_capacity_qp(k, x_min, x_max, self.total_supply, self.A_bar_value)
+
+    def _release_solver(self, key, solver):
+        """
+        Return a workspace taken with _acquire_solver to the idle pool.
+        """
+        with self._lock:
+            self._solvers[key].append(solver)
 
-    def optimize_capacity(self, current_sites, demand, constraints=(1, None)):
+    def _get_step_gram(self, selected_sites):
+        """
+        Return the demand-weighted Gram terms of the already selected sites, computed once per greedy step.
+
+        Returns:
+        - tuple: (F_s.T @ D @ F_s, F_s.T @ D @ F) where F_s holds the decay columns of the selected sites.
+          A candidate's Gram matrix is the first block bordered by one column of the second.
+        """
+        key = tuple(selected_sites)
+        with self._lock:
+            if key != self._step_key:
+                DF_selected = self.DF[:, selected_sites]
+                self._step_gram = ((self.F[:, selected_sites].T @ DF_selected).toarray(), (DF_selected.T @ self.F).toarray())
+                self._step_key = key
+            return self._step_gram
+
+    def calculate_accessibility(self, current_sites, optimized_supply):
+        """
+        Calculate the Accessibility Index (Ai) at every demand point for a supply distribution over the given sites.
+        """
+        return self.F[:, current_sites] @ (optimized_supply / self._column_demand[current_sites])
+
+    def optimize_capacity(self, current_sites, demand, constraints=(1, None), calculate_Ai=True, initial_supply=None):
         """
         Optimize supply distribution across selected sites using Quadratic Programming (QP).
 
@@ -60,64 +273,76 @@ class CapacityOptimizer:
         - current_sites (list): Indices of the currently selected sites.
         - demand (np.ndarray): Demand values for each demand point.
         - constraints (tuple): A tuple (x_min, x_max) specifying the lower and upper bounds for supply at each site.
+        - calculate_Ai (bool): If False, Ai_optimized is not computed and A_hat is derived from the QP solution alone,
+          which is enough to rank candidate sites.
+        - initial_supply (np.ndarray, optional): Starting point for the QP solver (warm start).
         
         Returns:
         - optimized_supply (np.ndarray): Optimized supply values for the selected sites.
-        - Ai_optimized (np.ndarray): Optimized Accessibility Index (Ai) values for the demand points.
+        - Ai_optimized (np.ndarray or None): Optimized Accessibility Index (Ai) values for the demand points.
         - A_hat (float): The root mean square deviation (RMSD) of the Ai values from the average accessibility.
         """
         try:
-            F_current = self.F[:, current_sites]
-            G_diag = 1.0 / np.sum(demand[:, np.newaxis] * F_current, axis=0)
-            A_bar = np.full(F_current.shape[0], self.A_bar_value)
-            P = F_current @ np.diag(G_diag)
+            # Only the last site differs between the candidates of one greedy step, so F.T @ D @ F for the
+            # current sites is the cached Gram block of the selected sites bordered by the candidate's row.
+            *selected_sites, site = current_sites
+            base_gram, cross_gram = self._get_step_gram(selected_sites)
+            k = len(current_sites)
+            gram = np.empty((k, k))
+            gram[:-1, :-1] = base_gram
+            gram[:-1, -1] = gram[-1, :-1] = cross_gram[:, site]
+            gram[-1, -1] = self._gram_diag[site]
 
-            x = cp.Variable(len(current_sites))  # Variables representing the supply to be optimized at each site
+            # With P = F @ diag(G), P.T @ D @ P is a diagonal similarity transform of the Gram matrix
+            G_diag = 1.0 / self._column_demand[current_sites]
 
             # Add a small epsilon to ensure numerical stability in the optimization.
-            # The matrix P.T @ self.D @ P can potentially be near-singular,
+            # The matrix P.T @ D @ P can potentially be near-singular,
             # meaning that its eigenvalues might be very close to zero, which can cause numerical issues
             # during optimization. Adding a small epsilon to the diagonal (as done here with np.eye) 
             # helps to make the matrix better conditioned (more stable for inversion or positive semi-definite operations).
             epsilon = 1e-8
-            P_T_D_P = P.T @ self.D @ P + epsilon * np.eye(P.shape[1])
-
-            # Use cp.psd_wrap to ensure that the matrix passed to cp.quad_form is treated as a 
-            # positive semi-definite (PSD) matrix. In optimization problems, especially with quadratic forms, 
-            # it's important for the matrix to be PSD to ensure the problem remains convex. 
-            # By wrapping the matrix with cp.psd_wrap, we make sure cvxpy treats it correctly, even in cases 
-            # where numerical precision might make it appear not PSD.
-            objective = cp.Minimize(0.5 * cp.quad_form(x, cp.psd_wrap(P_T_D_P)) - (P.T @ self.D @ A_bar) @ x)
-
-            # Define the constraints
-            # In this project, for the Atlanta metropolitan area, the constraints are set to (2, 25),
-            # meaning the minimum supply per site is 2, and the maximum is 25.
-            # For other areas, the constraints are set to (1, None), meaning the minimum supply is 1
-            # with no upper limit.
-            constraint_list = []
-            x_min, x_max = constraints
-            
-            # Add minimum and maximum constraints based on the area
-            if x_min is not None:
-                constraint_list.append(x >= x_min)
-            if x_max is not None:
-                constraint_list.append(x <= x_max)
-            
-            # Ensure the total supply matches the predefined total
-            constraint_list.append(cp.sum(x) == self.total_supply)
-
-            # Solve the QP problem
-            prob = cp.Problem(objective, constraint_list)
-            prob.solve(solver=cp.OSQP)
-
-            optimized_supply = x.value
-            Ai_optimized = P @ optimized_supply
-            A_hat = self.calculate_metrics(Ai_optimized, demand, calculate_all=False)
+            P_T_D_P = G_diag[:, np.newaxis] * gram * G_diag + epsilon * np.eye(k)
+
+            # A site without demand in its capture range has no finite G; reject it before it reaches the
+            # persistent solver workspace
+            if not np.all(np.isfinite(P_T_D_P)):
+                raise ValueError("a selected site has no demand within the capture range")
+
+            # Solve the QP problem. OSQP starts from the given initial supply, or from the solution of the
+            # previous candidate evaluated with this workspace.
+            key, workspace = self._acquire_solver(k, constraints)
+            solver, (rows, cols) = workspace
+            try:
+                solver.update(Px=P_T_D_P[rows, cols])
+                if initial_supply is not None:
+                    solver.warm_start(x=initial_supply)
+                results = solver.solve()
+            finally:
+                self._release_solver(key, workspace)
+            if results.info.status_val not in _OSQP_SOLVED:
+                raise ValueError(f"OSQP status: {results.info.status}")
+
+            optimized_supply = np.array(results.x)
+            if calculate_Ai:
+                Ai_optimized = self.calculate_accessibility(current_sites, optimized_supply)
+                A_hat = self.calculate_metrics(Ai_optimized, demand, calculate_all=False)
+            else:
+                # (Ai - A_bar).T @ D @ (Ai - A_bar) expands into terms of the QP data, with Ai = P @ x:
+                # x.T @ P.T @ D @ P @ x - 2 * A_bar * sum(x) + A_bar^2 * total_demand
+                Ai_optimized = None
+                weighted_supply = G_diag * optimized_supply
+                squared_deviation = (
+                    weighted_supply @ gram @ weighted_supply
+                    - 2 * self.A_bar_value * np.sum(optimized_supply)
+                    + self.A_bar_value ** 2 * self.total_demand
+                )
+                A_hat = np.sqrt(max(squared_deviation, 0) / self.total_demand)
 
         except Exception as e:
             logging.error(f"Optimization failed: {e}")
             optimized_supply = np.zeros(len(current_sites))
-            Ai_optimized = np.full(len(demand), np.inf)
+            Ai_optimized = np.full(len(demand), np.inf) if calculate_Ai else None
             A_hat = np.inf
 
         return optimized_supply, Ai_optimized, A_hat
@@ -125,33 +350,18 @@ class CapacityOptimizer:
     def calculate_metrics(self, Ai_optimized, demand, calculate_all=True):
         """
         Calculate various metrics for the optimized supply distribution.
-        """
-        diff = Ai_optimized - self.A_bar_value
-        abs_diff = np.abs(diff)
-        A_hat = np.sqrt(np.dot(diff ** 2, demand) / self.total_demand)
 
+        Returns:
+        - tuple: (A_hat, min_Ai, max_Ai, MD, MAD, CV, Gini), or only A_hat if calculate_all is False.
+        """
         if not calculate_all:
-            return A_hat
-
-        min_Ai = np.min(Ai_optimized)
-        max_Ai = np.max(Ai_optimized)
-        MD = np.max(abs_diff)
-        MAD = np.dot(abs_diff, demand) / self.total_demand
-        CV = A_hat / self.A_bar_value
-
-        # Calculate Gini coefficient
-        sorted_indices = np.argsort(Ai_optimized)
-        sorted_Ai = Ai_optimized[sorted_indices]
-        sorted_Di = demand[sorted_indices]
-        
-        sorted_Ai_Di = sorted_Ai * sorted_Di
-        sum_Ai_Di = np.sum(sorted_Ai_Di)
-        
-        P = np.cumsum(sorted_Di) / self.total_demand
-        T = np.cumsum(sorted_Ai_Di) / sum_Ai_Di
-        Gini = 1 + np.sum(P[:-1] * T[1:]) - np.sum(T[:-1] * P[1:])
+            diff = Ai_optimized - self.A_bar_value
+            return np.sqrt(np.dot(diff ** 2, demand) / self.total_demand)
 
-        return A_hat, min_Ai, max_Ai, MD, MAD, CV, Gini
+        return _metrics_kernel(
+            np.ascontiguousarray(Ai_optimized), np.ascontiguousarray(demand),
+            float(self.total_demand), float(self.A_bar_value)
+        )
 
     def calculate_coverage(self, selected_sites, distance_matrix, demand_values):
         """
@@ -162,9 +372,19 @@ class CapacityOptimizer:
         if total_demand == 0:
             return 0
 
-        distances_to_selected_sites = distance_matrix[:, selected_sites]
-        covered_mask = np.any(distances_to_selected_sites <= self.capture_range, axis=1)
-        covered_demand = np.sum(demand_values[covered_mask])
+        if sp.issparse(distance_matrix):
+            distance_matrix = sp.csr_matrix(distance_matrix)
+            is_selected = np.zeros(distance_matrix.shape[1], dtype=np.bool_)
+            is_selected[selected_sites] = True
+            covered_demand = _covered_demand_sparse(
+                distance_matrix.indptr, distance_matrix.indices, distance_matrix.data,
+                is_selected, demand_values, float(self.capture_range)
+            )
+        else:
+            covered_demand = _covered_demand(
+                np.ascontiguousarray(distance_matrix), np.asarray(selected_sites, dtype=np.int64),
+                demand_values, float(self.capture_range)
+            )
         coverage_ratio = (covered_demand / total_demand) * 100
 
         return coverage_ratio
\ No newline at end of file
@@ -1,13 +1,21 @@
+import ast
 import logging
+import multiprocessing
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import rasterio
 from joblib import Parallel, delayed
 
 from .capacity_optimizer import CapacityOptimizer
 from .process_polygon import process_polygon
+from .utils import setup_logging
 
 
 def update_supply(poi_supply, selected_sites, supply_values):
@@ -26,6 +34,31 @@ def update_supply(poi_supply, selected_sites, supply_values):
     return poi_supply
 
 
+def select_initial_sites(candidate_sites, initial_selected_sites):
+    """
+    A function that finds the indices of the initial POIs among the candidate sites.
+
+    Args:
+    - candidate_sites (list): OSM IDs of the candidate sites.
+    - initial_selected_sites (list or str): OSM IDs of the initial POIs. A polygon layer read back from a file
+      stores the list as its string representation (e.g. "['9158965903']").
+
+    Returns:
+    - list: Indices of the candidate sites that are initial POIs, in candidate order.
+    """
+    if isinstance(initial_selected_sites, str):
+        initial_selected_sites = ast.literal_eval(initial_selected_sites)
+    initial_ids = {str(osm_id) for osm_id in initial_selected_sites or []}
+
+    # One pass over the candidates with set lookups instead of scanning the initial POIs for every candidate
+    selected_sites = [i for i, osm_id in enumerate(candidate_sites) if osm_id in initial_ids]
+
+    missing_ids = initial_ids.difference(candidate_sites)
+    if missing_ids:
+        logging.warning(f"Initial POIs not found among the candidate sites: {sorted(missing_ids)}")
+    return selected_sites
+
+
 def log_polygon_info(polygon_id, total_supply, optimizer, selected_sites, distance_matrix, demand_values):
     """
     Log information about the processed region polygon.
@@ -53,7 +86,7 @@ def log_optimization_step(n, max_sites, best_site, best_A_hat, coverage_ratio):
     logging.info(log_message)
 
 
-def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, constraints, output_path, save_intermediate=False):
+def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, constraints, output_path, save_intermediate=False, n_jobs=None):
     """
     Perform greedy optimization to select Electric Vehicle Charging Station (EVCS) locations and optimize supply distribution
     within a given region polygon.
@@ -65,13 +98,14 @@ def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, co
 
     Args:
     - polygon (GeoSeries): The polygon geometry representing the region of interest for optimization.
-    - tif_file (str): Path to the demand GeoTIFF file.
+    - tif_file (str or DatasetReader): Path to the demand GeoTIFF file, or the already opened dataset.
     - poi_gdf (GeoDataFrame): GeoDataFrame containing candidate POI data, including OSM IDs and coordinates for potential EVCS locations.
     - capture_range (int): The maximum coverage radius for demand coverage calculation.
     - bandwidth (int): The bandwidth for the Gaussian decay function in optimization.
     - constraints (tuple): A tuple specifying the lower and upper limits for site selection (e.g., (min_sites, max_sites)).
     - output_path (str): Directory to save the output files (intermediate and final results).
     - save_intermediate (bool, optional): If True, saves intermediate results such as supply distribution and coverage at each step.
+    - n_jobs (int, optional): Number of threads evaluating candidate sites. Defaults to the number of CPUs.
 
     Returns:
     - None: Results are saved as CSV and GPKG files in the specified output directory.
@@ -83,7 +117,7 @@ def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, co
     optimizer = CapacityOptimizer(total_supply, demand_values, distance_matrix, bandwidth=bandwidth, capture_range=capture_range)
 
     # Select initial sites based on the initial POIs
-    selected_sites = [i for i, osm_id in enumerate(candidate_sites) if osm_id in initial_selected_sites]
+    selected_sites = select_initial_sites(candidate_sites, initial_selected_sites)
     initial_site_count = len(selected_sites)
 
     # Log processed polygon information
@@ -94,8 +128,9 @@ def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, co
     initial_supply_value = total_supply / len(selected_sites)
     poi_supply[selected_sites] = initial_supply_value
 
-    # Update the list of candidate sites (exclude already selected ones)
-    remaining_candidate_sites = list(set(range(len(poi_supply))) - set(selected_sites))
+    # Mark the candidate sites that can still be selected (exclude already selected ones)
+    available = np.ones(len(candidate_sites), dtype=bool)
+    available[selected_sites] = False
 
     results_list = []
 
@@ -106,67 +141,79 @@ def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, co
         os.makedirs(supply_path, exist_ok=True)
         os.makedirs(ai_path, exist_ok=True)
 
-    for n in range(initial_site_count + 1, max_sites + 1):
-        best_site = None
-        best_A_hat = np.inf
-        best_optimized_supply = None
-        best_Ai_optimized = None
-
-        # Parallel optimization for candidate site selection
-        results = Parallel(n_jobs=os.cpu_count())(
-            delayed(lambda site: (optimizer.optimize_capacity(selected_sites + [site], demand_values, constraints), site))(site)
-            for site in remaining_candidate_sites
-        )
-
-        all_infinite = True
-
-        for ((optimized_supply, Ai_optimized, A_hat), site) in results:
-            if A_hat < best_A_hat:
-                best_A_hat = A_hat
-                best_site = site
-                best_optimized_supply = optimized_supply
-                best_Ai_optimized = Ai_optimized
-                all_infinite = False
-
-        if all_infinite:
-            logging.warning(f"All A_hat values are infinite at step {n}. There's no any solutions for the optimal supply. Terminating early.")
-            break
-
-        # Calculate coverage after optimization
-        coverage_ratio = optimizer.calculate_coverage(selected_sites, distance_matrix, demand_values)
-
-        # Log the optimization result for this step
-        log_optimization_step(n, max_sites, best_site, best_A_hat, coverage_ratio)
-
-        # Calculate additional optimization metrics
-        min_Ai, max_Ai, MD, MAD, CV, Gini = optimizer.calculate_metrics(best_Ai_optimized, demand_values)[1:]
-
-        # Update selected sites and remove the chosen site from the candidate list
-        selected_sites.append(best_site)
-        remaining_candidate_sites.remove(best_site)
-
-        # Update the supply for the selected sites
-        poi_supply = update_supply(poi_supply, selected_sites, best_optimized_supply)
-
-        # Store the optimization result for this step
-        result = {
-            'Step': n,
-            'Selected_Site': best_site,
-            'A_hat': best_A_hat,
-            'min_Ai': min_Ai,
-            'max_Ai': max_Ai,
-            'MD': MD,
-            'MAD': MAD,
-            'CV': CV,
-            'Gini': Gini
-        }
-
-        results_list.append(result)
-
-        # Save intermediate results if required
-        if save_intermediate:
-            np.savetxt(os.path.join(supply_path, f"supply_{n}.ssv"), poi_supply, delimiter=' ', fmt='%.4f')
-            np.savetxt(os.path.join(ai_path, f"Ai_{n}.ssv"), best_Ai_optimized, delimiter=" ")
+    # Candidate evaluations run on threads that share the optimizer instead of pickling it to worker processes
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+        for n in range(initial_site_count + 1, max_sites + 1):
+            best_site = None
+            best_A_hat = np.inf
+            best_optimized_supply = None
+
+            # The optimal supply of the previous step, with an average share for the added site,
+            # is the starting point of every candidate's QP
+            initial_supply = np.append(poi_supply[selected_sites] * (n - 1) / n, total_supply / n)
+
+            # Set up the QP solver for this step's number of sites; it is released as soon as the sweep is done
+            optimizer.prepare_solver(n, constraints)
+
+            # Parallel optimization for candidate site selection.
+            # Candidates are ranked by A_hat alone; Ai is only computed for the chosen site.
+            results = list(executor.map(
+                lambda site: (optimizer.optimize_capacity(
+                    selected_sites + [site], demand_values, constraints, calculate_Ai=False, initial_supply=initial_supply
+                ), site),
+                np.flatnonzero(available)
+            ))
+            optimizer.free_solvers(n, constraints)
+
+            all_infinite = True
+
+            for ((optimized_supply, _, A_hat), site) in results:
+                if A_hat < best_A_hat:
+                    best_A_hat = A_hat
+                    best_site = site
+                    best_optimized_supply = optimized_supply
+                    all_infinite = False
+
+            if all_infinite:
+                logging.warning(f"All A_hat values are infinite at step {n}. There's no any solutions for the optimal supply. Terminating early.")
+                break
+
+            # Calculate the accessibility and optimization metrics of the chosen site
+            best_Ai_optimized = optimizer.calculate_accessibility(selected_sites + [best_site], best_optimized_supply)
+            best_A_hat, min_Ai, max_Ai, MD, MAD, CV, Gini = optimizer.calculate_metrics(best_Ai_optimized, demand_values)
+
+            # Calculate coverage after optimization
+            coverage_ratio = optimizer.calculate_coverage(selected_sites, distance_matrix, demand_values)
+
+            # Log the optimization result for this step
+            log_optimization_step(n, max_sites, best_site, best_A_hat, coverage_ratio)
+
+            # Update selected sites and remove the chosen site from the candidates
+            selected_sites.append(best_site)
+            available[best_site] = False
+
+            # Update the supply for the selected sites
+            poi_supply = update_supply(poi_supply, selected_sites, best_optimized_supply)
+
+            # Store the optimization result for this step
+            result = {
+                'Step': n,
+                'Selected_Site': best_site,
+                'A_hat': best_A_hat,
+                'min_Ai': min_Ai,
+                'max_Ai': max_Ai,
+                'MD': MD,
+                'MAD': MAD,
+                'CV': CV,
+                'Gini': Gini
+            }
+
+            results_list.append(result)
+
+            # Save intermediate results if required
+            if save_intermediate:
+                np.savetxt(os.path.join(supply_path, f"supply_{n}.ssv"), poi_supply, delimiter=' ', fmt='%.4f')
+                np.savetxt(os.path.join(ai_path, f"Ai_{n}.ssv"), best_Ai_optimized, delimiter=" ")
 
     # Create the output directory for the polygon-specific results
     polygon_output_path = os.path.join(output_path, str(polygon_id))
@@ -192,7 +239,121 @@ def greedy_optimization(polygon, tif_file, poi_gdf, capture_range, bandwidth, co
     # Reorder columns and save the result as a GeoPackage (GPKG) file
     gpd.GeoDataFrame(gdf_selected_poi[['osm_id', 'fclass', 'supply', 'geometry']], geometry='geometry')\
         .set_crs(epsg=3857)\
-        .to_file(os.path.join(output_path, polygon_id, f"{polygon_id}.gpkg"), layer=polygon_id, driver="GPKG")
+        .to_file(os.path.join(output_path, polygon_id, f"{polygon_id}.gpkg"), layer=polygon_id, driver="GPKG", engine="pyogrio")
 
     # Log the completion of the optimization process
     logging.info(f"Optimization process for {polygon_id} complete")
+
+
+_demand_map = (None, None)  # ((path, mtime), open dataset) of the demand GeoTIFF in this process
+
+
+def _open_demand_map(tif_file):
+    """
+    Open the demand GeoTIFF once per process; the handle is kept for every polygon the process optimizes.
+
+    The handle is keyed on the file's path and modification time, so a GeoTIFF regenerated at the same path
+    is reopened (and the stale handle closed) even in a reused worker process.
+    """
+    global _demand_map
+    key = (os.path.abspath(tif_file), os.path.getmtime(tif_file))
+    cached_key, src = _demand_map
+    if cached_key != key:
+        if src is not None:
+            src.close()
+        src = rasterio.open(tif_file)
+        _demand_map = (key, src)
+    return src
+
+
+@lru_cache(maxsize=1)
+def _load_pois(poi_file):
+    """
+    Load the POIs once per process and build their spatial index, which is then reused for every polygon
+    the process optimizes. A GeoDataFrame's spatial index is not pickled, so the POIs are passed to the
+    workers as a file instead of as an argument of every task.
+    """
+    poi_gdf = gpd.read_parquet(poi_file)
+    poi_gdf.sindex
+    return poi_gdf
+
+
+def _forward_logging(log_queue, log_level, parent_pid):
+    """
+    Route the log records of a worker process to the parent through log_queue, so they reach the handlers
+    the parent configured (its log file and its console or notebook output).
+    """
+    # joblib runs the tasks in the parent itself when n_jobs=1; its logging is already in place there
+    if os.getpid() == parent_pid:
+        return
+    # Reused workers still hold the handler of an earlier run, whose queue is gone
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(log_level)
+
+
+def _optimize_polygon(polygon, tif_file, poi_file, capture_range, bandwidth, constraints, output_path, save_intermediate,
+                      log_queue, log_level, parent_pid):
+    """
+    Worker for optimize_polygons: optimize one polygon with a sequential candidate sweep.
+    """
+    # Worker processes do not inherit the logging configuration of the parent
+    _forward_logging(log_queue, log_level, parent_pid)
+
+    greedy_optimization(
+        polygon,
+        _open_demand_map(tif_file),
+        _load_pois(poi_file),
+        capture_range=capture_range,
+        bandwidth=bandwidth,
+        constraints=constraints,
+        output_path=output_path,
+        save_intermediate=save_intermediate,
+        n_jobs=1
+    )
+
+
+def optimize_polygons(polygons, tif_file, poi_gdf, capture_range, bandwidth, constraints, output_path, save_intermediate=False, n_jobs=None):
+    """
+    Run greedy_optimization for every region polygon in a GeoDataFrame.
+
+    Polygons are independent, so they are distributed over worker processes, each of which evaluates its
+    candidate sites sequentially. Every worker opens the demand GeoTIFF and loads the POIs (with their spatial
+    index) once and reuses them for all its polygons.
+
+    Args:
+    - polygons (GeoDataFrame): Region polygons with the attributes required by process_polygon.
+    - tif_file (str): Path to the demand GeoTIFF file.
+    - n_jobs (int, optional): Number of worker processes. Defaults to the number of CPUs.
+    - The remaining arguments are passed to greedy_optimization unchanged.
+
+    Returns:
+    - None: Results are saved as CSV and GPKG files in the specified output directory.
+    """
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        setup_logging()
+
+    # Log records of the workers are sent back over a queue and emitted by the parent's own handlers
+    with multiprocessing.Manager() as manager:
+        log_queue = manager.Queue()
+        listener = QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+        listener.start()
+
+        # Hand the POIs to the workers through a temporary GeoParquet file, read once per worker
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                poi_file = os.path.join(tmp_dir, "pois.parquet")
+                poi_gdf.to_parquet(poi_file)
+
+                Parallel(n_jobs=n_jobs or os.cpu_count(), backend='loky')(
+                    delayed(_optimize_polygon)(
+                        polygon, tif_file, poi_file, capture_range, bandwidth, constraints, output_path, save_intermediate,
+                        log_queue, root_logger.getEffectiveLevel(), os.getpid()
+                    )
+                    for _, polygon in polygons.iterrows()
+                )
+        finally:
+            listener.stop()
@@ -1,21 +1,29 @@
+import os
+from contextlib import nullcontext
+
 import numpy as np
 import rasterio
-from rasterio.mask import mask
-from scipy.spatial.distance import cdist
+import shapely
+from rasterio.features import geometry_window
+from scipy.sparse import csr_matrix
 from shapely.geometry import MultiPolygon
 from shapely.ops import unary_union
+from sklearn.neighbors import BallTree
 
 
 def process_polygon(polygon, tif_file, poi_gdf, capture_range):
     """
     Main function to process a polygon, calculate demand values, and generate distance metrics.
+
+    The demand map can be given as a path or as an already opened rasterio dataset, which lets callers
+    processing many polygons open the GeoTIFF once.
     """
     
-    # Handle MultiPolygon: merge into a single polygon if necessary
-    if isinstance(polygon.geometry, MultiPolygon):
-        polygon_geom = unary_union(polygon.geometry)
-    else:
-        polygon_geom = polygon.geometry
+    # Buffering handles the parts of a MultiPolygon directly. Only an invalid MultiPolygon (overlapping parts)
+    # needs to be dissolved for the POI containment test; a valid one would come out of unary_union unchanged.
+    polygon_geom = polygon.geometry
+    if isinstance(polygon_geom, MultiPolygon) and not polygon_geom.is_valid:
+        polygon_geom = unary_union(polygon_geom)
 
     # Extract relevant polygon attributes
     polygon_id = polygon['NAMELSAD20']  # Polygon ID (e.g., name of the area)
@@ -26,30 +34,51 @@ def process_polygon(polygon, tif_file, poi_gdf, capture_range):
     # 1. Calculate demand values and coordinates (apply capture_range buffer)
     buffered_polygon = polygon_geom.buffer(capture_range)
     
-    with rasterio.open(tif_file) as src:
-        # Mask the demand map with the buffered polygon and crop the result
-        out_image, out_transform = mask(src, [buffered_polygon], crop=True)
-        out_image = out_image[0]
-        
-        rows, cols = np.where(out_image > 0)
-        demand_values = out_image[rows, cols]
-        
-        # Transform row/col coordinates to geographic coordinates
-        demand_coords = [
-            (out_transform * (col, row)) for row, col in zip(rows, cols)
-        ]
+    with rasterio.open(tif_file) if isinstance(tif_file, (str, os.PathLike)) else nullcontext(tif_file) as src:
+        # Read only the window covering the buffered polygon
+        window = geometry_window(src, [buffered_polygon])
+        out_image = src.read(1, window=window)
+        out_transform = src.window_transform(window)
+
+    rows, cols = np.where(out_image > 0)
+
+    # Transform row/col coordinates to geographic coordinates, applying the affine transform to whole arrays
+    xs = out_transform.a * cols + out_transform.b * rows + out_transform.c
+    ys = out_transform.d * cols + out_transform.e * rows + out_transform.f
+
+    # Keep the cells whose center lies within the buffered polygon, matching what masking the raster selected,
+    # but testing only the positive cells instead of rasterizing the polygon over the whole window
+    within = shapely.contains_xy(
+        buffered_polygon,
+        xs + (out_transform.a + out_transform.b) / 2,
+        ys + (out_transform.d + out_transform.e) / 2
+    )
+    rows, cols = rows[within], cols[within]
+    demand_values = out_image[rows, cols].astype(np.float32)
+    demand_array = np.column_stack((xs[within], ys[within]))
 
     # 2. Filter POI data (only include POIs within the polygon area)
-    candidate_sites_within_polygon = poi_gdf[poi_gdf.within(polygon_geom)]
+    # The STRtree behind poi_gdf.sindex is built on first use and reused for every polygon processed with the same
+    # poi_gdf object (optimize_polygons loads one per worker process).
+    # Sorting the hits keeps the candidates in their original order.
+    poi_indices = np.sort(poi_gdf.sindex.query(polygon_geom, predicate='contains'))
+    candidate_sites_within_polygon = poi_gdf.iloc[poi_indices]
 
     # 3. Calculate the distance matrix between demand points and POI locations
-    demand_array = np.array(demand_coords)
-
     # Extract POI coordinates and corresponding OSM IDs
     candidate_sites_array = np.array([[point.x, point.y] for point in candidate_sites_within_polygon.geometry])
     candidate_sites_osm_ids = candidate_sites_within_polygon['osm_id'].tolist()
 
-    # Compute the distance matrix between demand points and POI locations
-    distance_matrix = cdist(demand_array, candidate_sites_array)
+    # Compute the distance matrix between demand points and POI locations.
+    # Distances beyond the capture range have no decay weight, so only the pairs within range are queried
+    # and stored in a sparse (CSR) matrix. Single precision is ample for distances in meters and halves the
+    # memory traffic of every pass over the matrix.
+    tree = BallTree(candidate_sites_array)
+    indices, distances = tree.query_radius(demand_array, r=capture_range, return_distance=True)
+    indptr = np.concatenate(([0], np.cumsum([len(row) for row in indices])))
+    distance_matrix = csr_matrix(
+        (np.concatenate(distances).astype(np.float32), np.concatenate(indices), indptr),
+        shape=(len(demand_array), len(candidate_sites_array))
+    )
 
     return polygon_id, total_supply, max_sites, demand_values, distance_matrix, candidate_sites_osm_ids, initial_selected_sites
\ No newline at end of file
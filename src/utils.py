@@ -1,38 +1,64 @@
 import logging
 import os
-import geopandas as gpd
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
+import pyogrio
 
-def merge_gpkg_files(output_path, output_file_name):
+def merge_gpkg_files(output_path, output_file_name, n_jobs=None):
     """
     Merge all GPKG files in the subdirectories under the output path into a single GPKG file.
-    """
-    gdf_list = []
 
-    # Traverse the output_path for GPKG files
-    for root, _, files in os.walk(output_path):
-        for file in files:
-            if file.endswith(".gpkg"):
-                gpkg_file_path = os.path.join(root, file)
-                try:
-                    gdf = gpd.read_file(gpkg_file_path)
-                    gdf_list.append(gdf)
-                except Exception as e:
-                    logging.error(f"Error reading {gpkg_file_path}: {str(e)}")
-
-    # Merge all GeoDataFrames
-    merged_gdf = gpd.GeoDataFrame(pd.concat(gdf_list, ignore_index=True))
+    Files are read on a thread pool (GDAL releases the GIL while reading) and appended to the merged file
+    in discovery order, one batch of n_jobs files at a time, so only one batch is held in memory.
+    Columns missing from a later file are written as nulls, and columns not in the first file are dropped.
+    """
     merged_gpkg_path = os.path.join(output_path, output_file_name)
 
-    # Save merged GeoDataFrame as a GPKG file
-    merged_gdf.to_file(merged_gpkg_path, driver="GPKG")
+    # Traverse the output_path for GPKG files
+    gpkg_file_paths = [
+        os.path.join(root, file)
+        for root, _, files in os.walk(output_path)
+        for file in files
+        if file.endswith(".gpkg") and os.path.abspath(os.path.join(root, file)) != os.path.abspath(merged_gpkg_path)
+    ]
+
+    n_jobs = n_jobs or os.cpu_count()
+    layer = os.path.splitext(output_file_name)[0]
+    columns = None
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for start in range(0, len(gpkg_file_paths), n_jobs):
+            for gdf in executor.map(_read_gpkg, gpkg_file_paths[start:start + n_jobs]):
+                if gdf is None:
+                    continue
+
+                # The first file creates (or replaces) the merged layer and fixes its schema;
+                # the others are aligned to that schema and appended to it
+                if columns is None:
+                    columns = gdf.columns
+                    pyogrio.write_dataframe(gdf, merged_gpkg_path, layer=layer, driver="GPKG")
+                else:
+                    pyogrio.write_dataframe(gdf.reindex(columns=columns), merged_gpkg_path, layer=layer, driver="GPKG", append=True)
+
+    if columns is None:
+        logging.warning(f"No GPKG files found under {output_path}")
+        return
     logging.info(f"All GPKG files successfully merged into {merged_gpkg_path}")
 
 
+def _read_gpkg(gpkg_file_path):
+    """
+    Read a GPKG file, logging the error and returning None if it cannot be read.
+    """
+    try:
+        return pyogrio.read_dataframe(gpkg_file_path, use_arrow=True)
+    except Exception as e:
+        logging.error(f"Error reading {gpkg_file_path}: {str(e)}")
+        return None
+
+
 def setup_logging(log_file="optimization.log"):
     """
     Configure the logging settings.
@@ -46,25 +72,32 @@ def setup_logging(log_file="optimization.log"):
         ]
     )
 
-def process_ev_charging_data(initial_pois_path, candidate_pois_path, polygons_path, charger_type, urban_polygons_path, region_type, save=True):
+def process_ev_charging_data(initial_pois_path, candidate_pois_path, polygons_path, charger_type, urban_polygons_path, region_type, save=True, show=True, cache=True):
     """
     Processes and visualizes the EV charging data for a given region based on the selected charger type (lv2 or dcfc) and region type.
+    Set show=False to skip the visualization, e.g. in batch runs, and cache=False to always read the input files directly.
     """
     
-    # Step 1: Load the data
-    initial_pois_gdf = gpd.read_file(initial_pois_path)
-    candidate_pois_gdf = gpd.read_file(candidate_pois_path)
-    polygons_gdf = gpd.read_file(polygons_path)
-    urban_polygons_gdf = gpd.read_file(urban_polygons_path)
+    if not logging.getLogger().handlers:
+        setup_logging()
 
-    # Step 2: Ensure all GeoDataFrames use the same coordinate system (EPSG:3857)
+    # Step 1 & 2: Load the data, ensuring all GeoDataFrames use the same coordinate system (EPSG:3857)
+    # Reprojected layers are cached as GeoParquet next to their source, so repeated runs over the same inputs
+    # (e.g. for each charger type) skip both the file parsing and the reprojection
     crs_epsg = 3857
     initial_pois_gdf, candidate_pois_gdf, polygons_gdf, urban_polygons_gdf = \
-        [gdf.to_crs(epsg=crs_epsg) for gdf in [initial_pois_gdf, candidate_pois_gdf, polygons_gdf, urban_polygons_gdf]]
+        [read_projected(path, crs_epsg, cache=cache) for path in [initial_pois_path, candidate_pois_path, polygons_path, urban_polygons_path]]
     
     # Step 3: Validate charger_type and select the appropriate column
     charger_column = 'lv2_count' if charger_type == 'lv2' else 'dcfc_count'
-    polygons_gdf = polygons_gdf[['NAMELSAD20', charger_column, 'geometry']].rename(columns={charger_column: 'total_supply'})
+    missing_columns = [column for column in ('NAMELSAD20', charger_column, 'geometry') if column not in polygons_gdf.columns]
+    if missing_columns:
+        raise KeyError(f"Polygon layer {polygons_path} is missing the columns {missing_columns}.")
+
+    # Drop the unused columns (including a stale total_supply) and rename in place, then fix the column order
+    polygons_gdf.drop(columns=[column for column in polygons_gdf.columns if column not in ('NAMELSAD20', charger_column, 'geometry')], inplace=True)
+    polygons_gdf.rename(columns={charger_column: 'total_supply'}, inplace=True)
+    polygons_gdf = polygons_gdf[['NAMELSAD20', 'total_supply', 'geometry']]
 
     # Ensure that total_supply is present in initial_pois_gdf, if not, create it from the appropriate charger count
     if 'total_supply' not in initial_pois_gdf.columns:
@@ -75,82 +108,130 @@ def process_ev_charging_data(initial_pois_path, candidate_pois_path, polygons_pa
         else:
             raise KeyError("Neither 'lv2_count' nor 'dcfc_count' is available to create 'total_supply'.")
     
-    # Print basic statistics
-    print(f"Initial POIs within {region_type} polygons: {initial_pois_gdf.shape[0]}")
-    print(f"Candidate POIs within {region_type} polygons: {candidate_pois_gdf.shape[0]}")
+    # Log basic statistics
+    logging.info(f"Initial POIs within {region_type} polygons: {initial_pois_gdf.shape[0]}")
+    logging.info(f"Candidate POIs within {region_type} polygons: {candidate_pois_gdf.shape[0]}")
 
     # Step 4: Calculate POI counts and osm_id lists for polygons
-    polygons_gdf = calculate_poi_counts_and_osm_ids(polygons_gdf, initial_pois_gdf, 'initial_count')
+    # Both POI layers and the MCLP selection below are matched against the spatial index cached on polygons_gdf;
+    # columns are only added to polygons_gdf in place, so the index is built once
+    polygons_sindex = polygons_gdf.sindex
+    polygons_gdf = calculate_poi_counts_and_osm_ids(polygons_gdf, initial_pois_gdf, 'initial_count', tree=polygons_sindex)
 
     # Step 5: Repeat POI counting for candidate POIs without osm_id_list
-    polygons_gdf = calculate_poi_counts(polygons_gdf, candidate_pois_gdf, 'candidate_count')
-
-    # Step 6: Calculate p values based on candidate count and total supply
-    polygons_gdf['p'] = polygons_gdf.apply(calculate_p, threshold=4, axis=1)
+    polygons_gdf = calculate_poi_counts(polygons_gdf, candidate_pois_gdf, 'candidate_count', tree=polygons_sindex)
 
-    # Adjust p values based on the candidate count
-    polygons_gdf['p'] = polygons_gdf.apply(lambda row: min(row['p'], row['candidate_count']), axis=1)
+    # Step 6: Calculate p values based on candidate count and total supply,
+    # capped at the candidate count
+    polygons_gdf['p'] = calculate_p(polygons_gdf, threshold=4)
 
     # Step 7: Separate polygons into MCLP and Greedy categories based on p
-    mclp_polygons = polygons_gdf[polygons_gdf['p'] == 1]
+    is_mclp = (polygons_gdf['p'] == 1).to_numpy()
     greedy_polygons = polygons_gdf[polygons_gdf['p'] > 1]
 
-    # Use initial POIs for MCLP polygons and perform spatial join
-    points_in_mclp_polygons = gpd.GeoDataFrame()
-    if not mclp_polygons.empty:
-        points_in_mclp_polygons = initial_pois_gdf[initial_pois_gdf.intersects(mclp_polygons.unary_union)][['osm_id', 'geometry', 'total_supply']]
+    # Use initial POIs for MCLP polygons; the whole selection is skipped when there are no MCLP polygons
+    points_in_mclp_polygons = None
+    if is_mclp.any():
+        # Each POI is tested against the indexed polygons instead of the union of the MCLP polygons;
+        # a POI on a shared border is kept once, in its original order
+        poi_idx, polygon_idx = polygons_sindex.query(initial_pois_gdf.geometry.values, predicate='intersects')
+        points_in_mclp_polygons = initial_pois_gdf.iloc[np.unique(poi_idx[is_mclp[polygon_idx]])][['osm_id', 'geometry', 'total_supply']]
 
     # Step 8: Save results if requested
     if save:
         save_gpkg(greedy_polygons, f'{region_type}_{charger_type}_greedy.gpkg')
-        if not points_in_mclp_polygons.empty:
+        if points_in_mclp_polygons is not None and not points_in_mclp_polygons.empty:
             save_gpkg(points_in_mclp_polygons, f'{region_type}_{charger_type}_mclp_selected.gpkg')
 
     # Step 9: Visualize results with subplots
-    visualize_ev_charging_data_with_subplots(urban_polygons_gdf, initial_pois_gdf, candidate_pois_gdf, greedy_polygons, charger_type)
+    if show:
+        visualize_ev_charging_data_with_subplots(urban_polygons_gdf, initial_pois_gdf, candidate_pois_gdf, greedy_polygons, charger_type)
 
 
-def calculate_poi_counts_and_osm_ids(polygons_gdf, pois_gdf, count_column):
+def read_projected(path, epsg, cache=True):
+    """
+    Reads a vector file and reprojects it to the given EPSG code.
+
+    With cache=True the reprojected layer is stored as GeoParquet in '<path>.<epsg>.parquet' and read from there
+    as long as it is not older than the source file. The cache is only invalidated by the source file's
+    modification time; delete it (or pass cache=False) if the source is replaced by an older file.
+    """
+    cache_path = f"{path}.{epsg}.parquet"
+    if cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return gpd.read_parquet(cache_path)
+
+    gdf = to_crs_if_needed(gpd.read_file(path, engine="pyogrio", use_arrow=True), epsg)
+    if cache:
+        try:
+            gdf.to_parquet(cache_path)
+        except OSError as e:
+            logging.warning(f"Could not cache {path} as {cache_path}: {str(e)}")
+    return gdf
+
+
+def to_crs_if_needed(gdf, epsg):
+    """
+    Reprojects a GeoDataFrame to the given EPSG code, skipping the reprojection if it is already in that CRS.
+    """
+    if gdf.crs is not None and gdf.crs.to_epsg() == epsg:
+        return gdf
+    return gdf.to_crs(epsg=epsg)
+
+
+def calculate_poi_counts_and_osm_ids(polygons_gdf, pois_gdf, count_column, tree=None):
     """
     Calculates the number of POIs within each polygon and stores the count in a new column.
     Additionally, creates a list of osm_ids for each polygon where applicable.
+
+    tree is the spatial index over polygons_gdf.geometry (polygons_gdf.sindex by default, or any shapely STRtree),
+    so that several POI layers can be matched against the same index.
     """
-    # Perform spatial join
-    pois_within_polygons = gpd.sjoin(pois_gdf[['osm_id', 'geometry']], polygons_gdf, how='left', predicate='within')
+    if tree is None:
+        tree = polygons_gdf.sindex
+
+    # Match each POI to the polygons it lies within, as (POI position, polygon position) pairs
+    poi_idx, polygon_idx = tree.query(pois_gdf.geometry.values, predicate='within')
 
     # Aggregate osm_id lists and calculate counts
-    if pois_within_polygons.shape[0] > 0:
+    if len(poi_idx) > 0:
         # Calculate POI counts for each polygon and store in count_column
-        polygons_gdf[count_column] = pois_within_polygons.groupby('index_right').size()
-
-        # Create osm_id_list for each polygon, converting osm_id to string
-        polygons_gdf['osm_id_list'] = pois_within_polygons.groupby('index_right')['osm_id'].agg(lambda x: [str(osm_id) for osm_id in x])
-
-        # Convert empty lists to NaN or filter them out
-        polygons_gdf['osm_id_list'] = polygons_gdf['osm_id_list'].apply(lambda x: x if x and len(x) > 0 else None)
+        counts = np.bincount(polygon_idx, minlength=len(polygons_gdf))
+        polygons_gdf[count_column] = counts
+
+        # Create osm_id_list for each polygon, converting the matched osm_ids to string in one pass.
+        # Sorting the pairs by polygon (then POI order) lays each polygon's osm_ids out contiguously,
+        # so the lists are slices of one array and no join table has to be grouped.
+        order = np.lexsort((poi_idx, polygon_idx))
+        osm_ids = pois_gdf['osm_id'].iloc[poi_idx[order]].astype(str).tolist()
+        ends = np.cumsum(counts)
+
+        # Polygons without POIs get None instead of an osm_id_list
+        polygons_gdf['osm_id_list'] = [osm_ids[end - count:end] or None for count, end in zip(counts, ends)]
     else:
-        print("Warning: No matching points were found within polygons.")
+        logging.warning("No matching points were found within polygons.")
         polygons_gdf[count_column] = 0
         polygons_gdf['osm_id_list'] = None
 
     return polygons_gdf
 
 
-def calculate_p(row, threshold):
+def calculate_p(polygons_gdf, threshold):
     """
-    Calculates the p value based on candidate count and total supply.
+    Calculates the p value of every polygon based on candidate count and total supply.
+    Polygons with at most one candidate get p = 1 and are solved with MCLP.
     """
-    if row['candidate_count'] == 1 or row['total_supply'] <= threshold:
-        return 1
-    return max(row['total_supply'] // threshold, 2)
+    candidate_count = polygons_gdf['candidate_count'].to_numpy()
+    total_supply = polygons_gdf['total_supply'].to_numpy()
+    p = np.where((candidate_count <= 1) | (total_supply <= threshold), 1, np.maximum(total_supply // threshold, 2))
+    return np.minimum(p, np.maximum(candidate_count, 1))
 
 
 def save_gpkg(gdf, path):
     """
     Saves a GeoDataFrame to a GeoPackage file.
     """
-    gdf.to_file(path, driver='GPKG')
-    print(f"Data saved to {path}")
+    gdf.to_file(path, driver='GPKG', engine='pyogrio')
+    logging.info(f"Data saved to {path}")
 
 
 def visualize_ev_charging_data_with_subplots(urban_polygons_gdf, initial_pois_gdf, candidate_pois_gdf, greedy_polygons_gdf, charger_type):
@@ -163,8 +244,11 @@ def visualize_ev_charging_data_with_subplots(urban_polygons_gdf, initial_pois_gd
 
     # Subplot 1: Plot urban polygons and POIs (initial and candidate)
     urban_polygons_gdf.plot(ax=axes[0], color='lightgray', edgecolor='black', alpha=0.5, label='Urban Polygon')
-    candidate_pois_gdf.plot(ax=axes[0], marker='x', color='red', markersize=50, label='Candidate POI', alpha=0.7)
-    initial_pois_gdf.plot(ax=axes[0], marker='o', color='blue', markersize=20, label='Initial POI', alpha=0.7)
+    # POIs are drawn with one scatter call per layer (a single collection) rather than per-feature artists
+    axes[0].scatter(candidate_pois_gdf.geometry.x.to_numpy(), candidate_pois_gdf.geometry.y.to_numpy(),
+                    marker='x', c='red', s=50, label='Candidate POI', alpha=0.7)
+    axes[0].scatter(initial_pois_gdf.geometry.x.to_numpy(), initial_pois_gdf.geometry.y.to_numpy(),
+                    marker='o', c='blue', s=20, label='Initial POI', alpha=0.7)
     axes[0].set_title(f'Polygons and POIs (Initial and Candidate) - {charger_type.upper()}', fontsize=15)
     axes[0].set_xlabel('Longitude', fontsize=12)
     axes[0].set_ylabel('Latitude', fontsize=12)
@@ -182,10 +266,14 @@ def visualize_ev_charging_data_with_subplots(urban_polygons_gdf, initial_pois_gd
     plt.show()
 
 
-def calculate_poi_counts(polygons_gdf, pois_gdf, count_column):
+def calculate_poi_counts(polygons_gdf, pois_gdf, count_column, tree=None):
     """
     Calculates the number of POIs within each polygon and stores the count in a new column.
+
+    tree is an optional spatial index over polygons_gdf.geometry, as in calculate_poi_counts_and_osm_ids.
     """
-    pois_within_polygons = gpd.sjoin(polygons_gdf, pois_gdf, how='left', predicate='contains')
-    polygons_gdf[count_column] = pois_within_polygons.groupby(pois_within_polygons.index).size()
-    return polygons_gdf
\ No newline at end of file
+    if tree is None:
+        tree = polygons_gdf.sindex
+    _, polygon_idx = tree.query(pois_gdf.geometry.values, predicate='within')
+    polygons_gdf[count_column] = np.bincount(polygon_idx, minlength=len(polygons_gdf))
+    return polygons_gdf